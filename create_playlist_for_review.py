@@ -11,13 +11,17 @@ Renders out editorial deliverables from a reel of shot masters and creates a cli
 contact: andrew.miller@mtifilm.com
 '''
 
-import flame, os, time
+import flame, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
 # Path and environment var constants to minimize os forking at run time
 SCRIPT_PATH = os.path.dirname(__file__)
 H264_PRESET = os.path.join(SCRIPT_PATH, 'export_presets', 'Shotgrid Version Creation.xml')
 DNX36_PRESET = os.path.join(SCRIPT_PATH, 'export_presets', 'Editorial DNx36.xml')
 
+# Keep concurrent uploads low to stay within ShotGrid's rate limits
+MAX_UPLOAD_WORKERS = 4
+
 def create_client_delivery(selection):
     '''
     Takes a PyReel in Flame containing slated offline shot masters and creates an h.264 and DNx36 for each.
@@ -44,52 +48,69 @@ def create_client_delivery(selection):
         return flame.messages.show_in_console('Playlist export cancelled: project must be linked to ShotGrid', type = 'error', duration = 5)
     
     sg_auth = sgtk.get_authenticated_user()
+    shotgrid = sg_auth.create_sg_connection()     # single connection shared by every ShotGrid step below
     project = flame_engine.context.project
 
-    export_editorial_files(mezzanines_reel, export_path)    # render DNx files to the chosen path
+    export_editorial_files(mezzanines_reel, export_path)    # render DNx files to the chosen path in the background while the ShotGrid steps run
 
-    sg_versions = create_versions(mezzanines_reel, project, export_path, sg_auth)       # create version entries in ShotGrid for each shot
-    send_h264s_to_shotgrid(mezzanines_reel, sg_versions, export_path, sg_auth)          # upload an H.264 to each shot's ShotGrid version
+    sg_versions = create_versions(mezzanines_reel, project, export_path, shotgrid, sg_auth)     # create version entries in ShotGrid for each shot
+    send_h264s_to_shotgrid(mezzanines_reel, sg_versions, export_path, sg_auth)                  # upload an H.264 to each shot's ShotGrid version
 
-    create_playlist(mezzanines_reel.name.get_value(), sg_versions, project, sg_auth)    # add the versions to a playlist named after the reel
+    create_playlist(mezzanines_reel.name.get_value(), sg_versions, project, shotgrid)           # add the versions to a playlist named after the reel
 
     return
 
-def create_versions(reel, project, path, sg_authorization):
+def create_versions(reel, project, path, shotgrid, sg_authorization):
     '''
     Creates a version in ShotGrid for each shot in a reel using info from its source version.
 
     :reel: PyReel containing offline shot masters (see create_shot_masters.py for generation)
     :project: Shotgrid project info dictionary extracted from engine context
     :path: path to the versions' H.264s
-    :sg_authorization: user authentication for ShotGrid API connection
+    :shotgrid: shotgrid API connection
+    :sg_authorization: user authentication for ShotGrid API connection, used to resolve the version's user
 
     returns a list of the created version dictionaries 
     '''
 
-    shotgrid = sg_authorization.create_sg_connection()
-    versions = []
+    # Values shared by every version
+    project_ref = {'type': 'Project', 'id': project['id']}
+    user_entity = sg_authorization.resolve_entity()
+    h264_folder = os.path.join(path, reel.name.get_value(), 'h264')
+
+    # Collect every shot and version code up front so ShotGrid can be queried once per entity type instead of once per clip
+    shot_names = [clip.versions[0].tracks[0].segments[0].shot_name.get_value() for clip in reel.clips]
+    version_codes = [clip.name.get_value() for clip in reel.clips]
+
+    shots = shotgrid.find('Shot', 
+                          [['code', 'in', shot_names], ['project', 'is', project_ref]], 
+                          ['code'])
+    shot_by_name = {shot['code']: shot for shot in shots}
+
+    filters = [['project', 'is', project_ref], 
+               ['entity', 'in', [{'type': 'Shot', 'id': shot['id']} for shot in shots]], 
+               ['content', 'is', 'Comp']]
+    tasks = shotgrid.find('Task', filters, ['entity'])
+    task_by_shot_id = {task['entity']['id']: task for task in tasks}
 
-    for clip in reel.clips :
-        shot_name = clip.versions[0].tracks[0].segments[0].shot_name.get_value()
-        shot = shotgrid.find_one('Shot', 
-                                 [['code', 'is', shot_name], ['project', 'is', {'type': 'Project', 'id': project['id']}]])
+    internal_versions = shotgrid.find('Version', 
+                                      [['code', 'in', version_codes]], 
+                                      ['code', 'description'])
+    internal_version_by_code = {version['code']: version for version in internal_versions}
 
-        filters = [['project', 'is', {'type': 'Project', 'id': project['id']}], 
-                   ['entity', 'is', {'type': 'Shot', 'id': shot['id']}], 
-                   ['content', 'is', 'Comp']]
-        task = shotgrid.find_one('Task', filters)
+    batch_data = []
 
-        internal_version = shotgrid.find_one('Version', 
-                                             [['code', 'is', clip.name.get_value()]], 
-                                             ['description'])
+    for clip, shot_name, version_code in zip(reel.clips, shot_names, version_codes) :
+        shot = shot_by_name[shot_name]
+        task = task_by_shot_id[shot['id']]
+        internal_version = internal_version_by_code[version_code]
 
-        version_data = {'code': clip.name.get_value(),
+        version_data = {'code': version_code,
                         'entity': {'type': 'Shot', 'id': shot['id']},
                         'sg_task': {'type': 'Task', 'id': task['id']},
-                        'project': {'type': 'Project', 'id': project['id']}, 
+                        'project': project_ref, 
                         'description': internal_version['description'],
-                        'user': sg_authorization.resolve_entity(),
+                        'user': user_entity,
                         'sg_status_list': 'rev',
                         'sg_first_frame': 1001,
                         'sg_last_frame': clip.duration.frame + 999,
@@ -97,19 +118,22 @@ def create_versions(reel, project, path, sg_authorization):
                         'sg_movie_aspect_ratio': clip.ratio,
                         'sg_uploaded_movie_frame_rate': float(clip.frame_rate.split()[0]),
                         'sg_movie_has_slate': True,
-                        'sg_path_to_movie': os.path.join(path, reel.name.get_value(), 'h264', f'{clip.name.get_value()}.mov')}
+                        'sg_path_to_movie': os.path.join(h264_folder, f'{version_code}.mov')}
 
-        version = shotgrid.create('Version', version_data)
+        batch_data.append({'request_type': 'create', 'entity_type': 'Version', 'data': version_data})
 
-        if version :
-            flame.messages.show_in_console(f'Client Delivery: Shotgrid review version created for {clip.name.get_value()}')
-            versions.append(version)
+    # Create all the versions in a single request
+    versions = shotgrid.batch(batch_data)
+
+    for version in versions :
+        flame.messages.show_in_console(f'Client Delivery: Shotgrid review version created for {version["code"]}')
 
     return versions
 
 def send_h264s_to_shotgrid(reel, versions, path, sg_authorization):
     '''
     Renders H.264s of every clip in the reel and uploads them to ShotGrid, linked to a version entry.
+    Uploads run concurrently on a small pool of threads, each with its own ShotGrid connection since the API client isn't thread safe.
 
     :reel: PyReel containing offline shot masters (see create_shot_masters.py for generation)
     :versions: list of version dicts generated by create_versions() for every shot in the reel
@@ -122,48 +146,64 @@ def send_h264s_to_shotgrid(reel, versions, path, sg_authorization):
 
     exporter.export(reel, H264_PRESET, path)
 
-    shotgrid = sg_authorization.create_sg_connection()
-
     generic_path = os.path.join(path, reel.name.get_value(), 'h264', 'VERSION_NAME.mov')
+    thread_data = threading.local()
+
+    def upload_movie(version):
+        if not hasattr(thread_data, 'shotgrid'):
+            thread_data.shotgrid = sg_authorization.create_sg_connection()
+
+        upload_h264(thread_data.shotgrid, version, generic_path.replace('VERSION_NAME', version['code']))
 
-    for version in versions:
-        h264_path = generic_path.replace('VERSION_NAME', version['code'])
-        try :
-            shotgrid.upload('Version', version['id'], h264_path, field_name = 'sg_uploaded_movie')
-        except :
-            time.sleep(1)
-            shotgrid.upload('Version', version['id'], h264_path, field_name = 'sg_uploaded_movie')
+        return version
+
+    with ThreadPoolExecutor(max_workers = MAX_UPLOAD_WORKERS) as executor:
+        for version in executor.map(upload_movie, versions):
+            flame.messages.show_in_console(f'Client Delivery: Movie uploaded to version {version["code"]}')
 
-        flame.messages.show_in_console(f'Client Delivery: Movie uploaded to version {version["code"]}')
     return
 
+def upload_h264(shotgrid, version, h264_path):
+    '''
+    Uploads a movie to the sg_uploaded_movie field of a ShotGrid version, retrying once on failure.
+
+    :shotgrid: shotgrid API connection
+    :version: version dict generated by create_versions()
+    :h264_path: path to the H.264 to upload
+    '''
+
+    try :
+        shotgrid.upload('Version', version['id'], h264_path, field_name = 'sg_uploaded_movie')
+    except :
+        time.sleep(1)
+        shotgrid.upload('Version', version['id'], h264_path, field_name = 'sg_uploaded_movie')
+
 def export_editorial_files(reel, path):
     '''
     Renders a DNx36 file to the supplied path for every clip in a reel.
+    The export runs as a background job since nothing else in the delivery depends on the DNx files.
 
     :reel: PyReel containing offline shot masters (see create_shot_masters.py for generation)
     :path: path to export the .mov's to
     '''
 
     exporter = flame.PyExporter()
-    exporter.foreground = True
+    exporter.foreground = False
 
     exporter.export(reel, DNX36_PRESET, path)
 
-    return flame.messages.show_in_console('Client Delivery: DNx36 Check Files Exported')
+    return flame.messages.show_in_console('Client Delivery: DNx36 Check Files export started in the background')
 
-def create_playlist(name, versions, project, sg_authorization):
+def create_playlist(name, versions, project, shotgrid):
     '''
     Creates a playlist on Shotgrid containing all the supplied version entries.
 
     :name: string to name the playlist
     :versions: list of version dicts generated by create_versions()
     :project: ShotGrid project info dict
-    :sg_authorization: user authentication for ShotGrid API connection
+    :shotgrid: shotgrid API connection
     '''
 
-    shotgrid = sg_authorization.create_sg_connection()    
-
     playlist_data = {'code': name,
                      'project': {'type': 'Project', 'id': project['id']},
                      'versions': [{'type': 'Version', 'id': version['id']} for version in versions]}
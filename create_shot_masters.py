@@ -11,7 +11,8 @@ Creates delivery master sequences for each shot on a sequence in flame.
 contact: andrew.miller@mtifilm.com
 '''
 
-import flame, os, shutil
+import flame, functools, os, re, shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 # Path and environment var constants to minimize os forking at run time
@@ -24,6 +25,9 @@ SLATE_TEMPLATE_PATH = os.environ.get('SLATE_TEMPLATE_PATH', os.path.join(SCRIPT_
 MEZZANINE_PRESET = os.path.join(SCRIPT_PATH, 'export_presets', 'Deliverable Mezzanines.xml')
 THUMBNAIL_SETUP = os.path.join(SCRIPT_PATH, 'setups', 'timeline_thumbnail.action')
 
+# Number of threads used to write slate setups to disk
+SLATE_WRITE_WORKERS = 8
+
 def build_shot_masters_from_sequence(selection):
     '''
     Takes a sequence of completed shots and creates online and offline slated master sequences using information from Shotgrid and the clips' metadata. 
@@ -51,25 +55,41 @@ def build_shot_masters_from_sequence(selection):
     offline_reel = reel_group.create_reel(submission_name)
     online_reel = reel_group.create_reel(submission_name.replace('comp_submissions', 'mti'))
 
-    resolutions = []
-    shot_names = {}
+    # Start each run with fresh slate templates in case they've been edited since the last run
+    load_slate_setup.cache_clear()
+    load_slate_text_lines.cache_clear()
 
-    offline_bg = flame.import_clips(SLATE_BG_PATH.replace('RESOLUTION', '1920x1080'), temp_reel)[0]
+    os.makedirs(TEMP_FOLDER, exist_ok = True)       # slate setups get written here, see write_slate_ttg()
+
+    shots = collect_sequence_segments(sequence)
+    shot_names = {shot.name.get_value(): shot.shot_name.get_value() for shot in shots}     # maps version names to shot codes
+
+    # Fetch the ShotGrid info for every shot's slate up front in one query per entity type
+    shot_by_code = {entry['code']: entry for entry in shotgrid.find('Shot', 
+                                                                     [['code', 'in', list(set(shot_names.values()))]], 
+                                                                     ['code', 'description'])}
+    version_by_code = {entry['code']: entry for entry in shotgrid.find('Version', 
+                                                                        [['code', 'in', list(shot_names)]], 
+                                                                        ['code', 'user', 'description'])}
 
-    for shot in collect_sequence_segments(sequence):
-        shot_names[shot.name.get_value()] = shot.shot_name.get_value()
+    # Slate values that are the same for every shot
+    project_name = flame_engine.context.project['name']
+    current_date = date.today().strftime('%-m/%-d/%Y')
 
+    offline_bg = flame.import_clips(SLATE_BG_PATH.replace('RESOLUTION', '1920x1080'), temp_reel)[0]
+    bg_by_resolution = {'1920x1080': offline_bg}        # slate backgrounds already imported into the temp reel
+    slates = []                                         # (master sequence, filled slate setup, setup file name) for every master
+
+    for shot in shots:
         # Create PySequence objects for both master versions
         online_master = shot.match(online_reel).open_as_sequence()
         offline_master = create_offline_sequence(shot, offline_reel, temp_reel)
         
         # Check if the correct resolution slate background has been imported and import it if not
         resolution = f'{online_master.width}x{online_master.height}'
-        if resolution not in resolutions:
-            online_bg = flame.import_clips(SLATE_BG_PATH.replace('RESOLUTION', resolution), temp_reel)[0]
-            resolutions.append(resolution)
-        else :
-            online_bg = [clip for clip in temp_reel.clips if clip.name.get_value().endswith(resolution)][0]
+        if resolution not in bg_by_resolution:
+            bg_by_resolution[resolution] = flame.import_clips(SLATE_BG_PATH.replace('RESOLUTION', resolution), temp_reel)[0]
+        online_bg = bg_by_resolution[resolution]
             
         # Grab a frame from the clip to use as the slate thumbnails
         online_thumbnail_clip = extract_thumbnail(shot, temp_reel)
@@ -80,16 +100,22 @@ def build_shot_masters_from_sequence(selection):
         insert_slate_frame(offline_master, shot, offline_bg, offline_thumbnail_clip)
 
         # Fill the slates up with the proper info 
-        slate_info = get_slate_info(shot, shotgrid)
-        slate_info['<PROJECT>'] = flame_engine.context.project['name']
+        slate_info = get_slate_info(shot, shot_by_code, version_by_code, project_name, current_date)
 
         slate_info['<RESOLUTION>'] = resolution
         slate_info['<COLOR_SPACE>'] = online_master.get_colour_space()
-        generate_slate(online_master, slate_info)
+        slates.append((online_master, generate_slate(slate_info), f'{slate_info["<CODE>"]}-{resolution}-{len(slates)}'))
 
         slate_info['<RESOLUTION>'] = '1920x1080'
         slate_info['<COLOR_SPACE>'] = 'Rec.709'
-        generate_slate(offline_master, slate_info)
+        slates.append((offline_master, generate_slate(slate_info), f'{slate_info["<CODE>"]}-1920x1080-{len(slates)}'))
+
+    # Write every slate setup to disk concurrently, then load them onto their masters from the main thread
+    with ThreadPoolExecutor(max_workers = SLATE_WRITE_WORKERS) as executor:
+        setup_paths = list(executor.map(lambda slate: write_slate_ttg(slate[1], slate[2]), slates))
+
+    for (master, _, _), setup_path in zip(slates, setup_paths):
+        apply_slate(master, setup_path)
 
     # clean up temp folders in flame and on disk
     flame.delete(temp_reel)
@@ -106,8 +132,7 @@ def build_shot_masters_from_sequence(selection):
     if not mezzanines_path :
         return flame.messages.show_in_console('Mezzanine export cancelled', type = 'error', duration = 5)
 
-    online_mezzanines = export_mezzanines(online_reel, mezzanines_path)
-    offline_mezzanines = export_mezzanines(offline_reel, mezzanines_path)
+    online_mezzanines, offline_mezzanines = export_mezzanines([online_reel, offline_reel], mezzanines_path)
     
     # Reimport the mezzanine files
     def import_online_mezzanines():
@@ -145,22 +170,23 @@ def get_sequences_folders(reel_group):
             'offline': sequences_library.create_folder('offline')}
 
 
-def export_mezzanines(reel, path):
+def export_mezzanines(reels, path):
     '''
-    Creates a custom flame exporter to render out DPX files of all the sequences in the provided reel
+    Creates a custom flame exporter to render out DPX files of all the sequences in the provided reels.
+    All the reels go to flame in a single export job rather than one job per reel.
 
-    :reel: PyReel containing shot master sequences
+    :reels: list of PyReels containing shot master sequences
     :path: path to render the DPX into
 
-    returns the path of the containing folder for the rendered DPX
+    returns list of the paths of the containing folders for the rendered DPX, in the same order as the reels
     '''
 
     exporter = flame.PyExporter()
     exporter.foreground = True
 
-    exporter.export(reel, MEZZANINE_PRESET, path)
+    exporter.export(reels, MEZZANINE_PRESET, path)
     
-    return os.path.join(path, reel.name.get_value())
+    return [os.path.join(path, reel.name.get_value()) for reel in reels]
 
 
 def insert_slate_frame(sequence, shot, bg, thumbnail_clip):
@@ -196,14 +222,10 @@ def collect_sequence_segments(sequence):
     returns list of PySegments
     '''
 
-    segments = []
-
-    for version in sequence.versions :
-        for track in version.tracks :
-            for segment in track.segments :
-                segments.append(segment)
-
-    return [segment for segment in segments if segment.type == 'Video Segment'] 
+    return [segment for version in sequence.versions 
+                    for track in version.tracks 
+                    for segment in track.segments 
+                    if segment.type == 'Video Segment']
 
 def create_offline_sequence(shot, sequence_reel, temp_reel):
     '''
@@ -248,127 +270,140 @@ def extract_thumbnail(shot, destination_reel, effects = False):
 
     return thumb_clip
 
+@functools.lru_cache(maxsize = 8)
 def load_slate_setup(resolution):
     '''
-    Load all the lines of a Text FX template setup into a python list
+    Load all the lines of a Text FX template setup. Cached so each template is only read from disk once per resolution.
 
     :resolution: string in the format '{width}x{height}' used to load in the correct setup file for the media being slated
 
-    returns list of .ttg lines as strings
+    returns tuple of .ttg lines as strings
     '''
 
     with open(SLATE_TEMPLATE_PATH.replace('RESOLUTION', resolution), 'r') as template:
-        setup_lines = template.readlines()
+        setup_lines = tuple(template.readlines())
         
     return setup_lines
 
-def generate_slate(shot_sequence, slate_info):
+@functools.lru_cache(maxsize = 8)
+def load_slate_text_lines(resolution):
     '''
-    Logic for filling in a slate template setup with relevant info for the provided shot master.
+    Finds the Text lines of a Text FX template setup, where the template tags live.
+
+    :resolution: string in the format '{width}x{height}' used to load in the correct setup file for the media being slated
+
+    returns dict mapping line numbers to Text lines. shared between calls so treat as read only.
+    '''
+
+    return {index: line for index, line in enumerate(load_slate_setup(resolution)) if line.startswith('Text')}
+
+def generate_slate(slate_info):
+    '''
+    Logic for filling in a slate template setup with relevant info for a shot master.
 
-    :shot_sequence: PySequence of a shot master where we will load the slate setup
     :slate_info: dict that maps generic template tags to their shot specific values. Use get_slate_info() to generate.
 
-    returns Text PyTimelineFX applied to a slate background PySegment
+    returns list of .ttg lines as strings, ready for write_slate_ttg()
     '''
 
     resolution = slate_info['<RESOLUTION>']
-    slate_setup = load_slate_setup(resolution)
-    text_lines = {index: line for index, line in enumerate(slate_setup) if line.startswith('Text')}
+    slate_setup = list(load_slate_setup(resolution))
+    text_lines = load_slate_text_lines(resolution)
 
-    for token, value in slate_info.items() :
-        new_lines = replace_token(token, value, text_lines)
-        
-        slate_setup = update_setup(slate_setup, new_lines)
-    
-    new_setup_path = write_slate_ttg(slate_setup, f'{slate_info["<CODE>"]}-{resolution}')
+    # Swap every template tag in a single pass over each Text line
+    replacements = {ascii_convert(token): ascii_convert(value or ' ') for token, value in slate_info.items()}
+    token_pattern = compile_token_pattern(tuple(replacements))
+
+    for index, line in text_lines.items() :
+        new_line = token_pattern.sub(lambda match: replacements[match.group(0)], line)
+
+        if new_line != line :
+            slate_setup[index] = new_line
+            slate_setup[index - 1] = f'TextLength {len(new_line.split()) - 1}\n'
+
+    return slate_setup
+
+def apply_slate(shot_sequence, setup_path):
+    '''
+    Adds a Text effect to the slate background of a shot master and loads a slate setup into it.
+
+    :shot_sequence: PySequence of a shot master where we will load the slate setup
+    :setup_path: path to a .ttg generated by write_slate_ttg()
+
+    returns Text PyTimelineFX applied to a slate background PySegment
+    '''
 
     slate = shot_sequence.versions[0].tracks[0].segments[0].create_effect('Text')
-    slate.load_setup(new_setup_path)
+    slate.load_setup(setup_path)
 
     return slate
 
-def get_slate_info(shot, shotgrid):
+@functools.lru_cache(maxsize = 8)
+def compile_token_pattern(patterns):
+    '''
+    Compiles a regex matching any of the supplied ascii converted template tags, longest first.
+    Cached since every slate uses the same set of tags.
+
+    :patterns: tuple of ascii converted template tags
+
+    returns compiled re.Pattern
+    '''
+
+    return re.compile('|'.join(re.escape(pattern) for pattern in sorted(patterns, key = len, reverse = True)))
+
+def get_slate_info(shot, shot_by_code, version_by_code, project_name, current_date):
     '''
-    Creates a dictionary that maps the tags from a slate template to the specific values of a supplied shot using the flame and shotgrid APIs
+    Creates a dictionary that maps the tags from a slate template to the specific values of a supplied shot using the flame API and prefetched shotgrid entries
 
     :shot: PySegment to generate slate for
-    :shotgrid: shotgrid API
+    :shot_by_code: dict mapping shot codes to shotgrid shot entries with a 'description' field
+    :version_by_code: dict mapping version codes to shotgrid version entries with 'user' and 'description' fields
+    :project_name: string of the shotgrid project name
+    :current_date: string of today's date as it should appear on the slate
 
     returns dict of format {'<TAG>': 'value'}
     '''
     version_name = shot.name.get_value()
-    shot_entry = shotgrid.find_one('Shot', [['code', 'is', shot.shot_name.get_value()]], ['description'])
-    version_entry = shotgrid.find_one('Version', [['code', 'is', version_name]], ['user','description'])
+    shot_code = shot.shot_name.get_value()
+    shot_entry = shot_by_code[shot_code]
+    version_entry = version_by_code[version_name]
 
     version_components = version_name.split('_')
     slate_info = {}
 
-    slate_info['<CODE>'] = shot.shot_name.get_value()
+    slate_info['<CODE>'] = shot_code
     slate_info['<DESCRIPTION>'] = shot_entry['description']
     slate_info['<TYPE>'] = version_components[-2]
     slate_info['<VERSION>'] = version_components[-1]
-    slate_info['<CURRENT_DATE>'] = date.today().strftime('%-m/%-d/%Y')
+    slate_info['<CURRENT_DATE>'] = current_date
     slate_info['<ARTIST>'] = version_entry['user']['name']
     slate_info['<DURATION>'] = f'{shot.source_duration.frame} frames'
     slate_info['<HANDLES>'] = f'{shot.head} frames'
     slate_info['<FILE_NAME>'] = f'{version_name}.mov'
     slate_info['<NOTES>'] = version_entry['description']
+    slate_info['<PROJECT>'] = project_name
 
     return slate_info
 
+@functools.lru_cache(maxsize = 4096)
 def ascii_convert(text_to_convert):
     '''
     Converts a string of text to a string of the unicode code values representing it.
     Adapted from Mike Vaglienty's slate maker script.
+    Results are cached since the same tokens and values come up on every shot's slates.
 
     :text_to_convert: string of text
 
     returns string of space-seperated int unicode values
     '''
 
-    text_to_convert = text_to_convert.replace('“', '"').replace('”', '"')
+    text_to_convert = text_to_convert.replace('“', '"').replace('”', '"').replace(chr(194), '')
 
-    ascii_list = []
+    return ' '.join(map(str, map(ord, text_to_convert)))
 
-    for char in text_to_convert:
-        ascii_num = ord(char)
-        if ascii_num != 194:
-            ascii_list.append(ascii_num)
-
-    ascii_code = ' '.join(str(a) for a in ascii_list)
-
-    return ascii_code
-
-def replace_token(token, value, text_lines):
-    '''
-    Searches for a template token in a text FX setup and replaces it with a supplied value
-
-    :token: string of a template tag eg. '<RESOLUTION>'
-    :value: string to insert into setup eg '3840x2160'
-
-    returns dict mapping the updated lines of the setup to thier line number
-    '''
-
-    if not value :
-        value = ' '
-
-    char_count = len(value)
-    pattern = ascii_convert(token)
-    pattern_replacement = ascii_convert(value)
-
-    new_lines = {}
-    
-    for index, line in text_lines.items():
-        if pattern in line:
-            new_lines[index] = line.replace(pattern, pattern_replacement)
-            new_lines[index - 1] = f'TextLength {char_count}\n'
-
-    return new_lines
-        
 def write_slate_ttg(setup_lines, file_name):
     '''
-    Creates a text setup .ttg file from strings in a list
+    Creates a text setup .ttg file from strings in a list. TEMP_FOLDER must already exist.
 
     :setup_lines: list of strings representing the text setup
     :file_name: string of the desired name for the text setup
@@ -376,9 +411,6 @@ def write_slate_ttg(setup_lines, file_name):
     returns string of the path of the generated .ttg file
     '''
 
-    if not os.path.exists(TEMP_FOLDER):
-        os.makedirs(TEMP_FOLDER)
-
     ttg_path = os.path.join(TEMP_FOLDER, f'{file_name}.ttg')
 
     with open(ttg_path, 'w') as new_setup :
@@ -386,21 +418,6 @@ def write_slate_ttg(setup_lines, file_name):
 
     return ttg_path
 
-def update_setup(setup, new_lines) :
-    '''
-    Replaces the lines of a text setup stored in a list with new values from a dictionary of template-tag replacements.
-
-    :setup: template setup as a list of strings
-    :new_lines: dict mapping updated setup lines to their index/line number
-
-    returns setup list with the updates applied
-    '''
-
-    for index, value in new_lines.items() :
-        setup[index] = value
-
-    return setup
-
 def delete_temp_folder():
     '''Deletes the temporary folder on disk used to store setup files for slates.'''
 